@@ -34,9 +34,14 @@
 # Manipulate data
 import numpy as np
 import pandas as pd
+from collections import defaultdict
+
+# Download data
+import hashlib
+import pathlib
+import urllib.request
 
 # Plots
-import seaborn as sns
 import matplotlib.pyplot as plt
 
 # Statistical tests
@@ -44,14 +49,15 @@ import scipy.stats as stats
 
 # Machine learning
 from sklearn.svm import LinearSVC
-import joblib
-from sklearn.metrics import accuracy_score, balanced_accuracy_score, confusion_matrix
+from joblib import Parallel, delayed
+from sklearn.metrics import confusion_matrix
 from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.model_selection import KFold, StratifiedKFold
 
-# Ignore WARNING
+# Control warnings
 import warnings
-warnings.filterwarnings('ignore')
 
 
 # ## Set random seed
@@ -94,7 +100,28 @@ np.random.seed(random_seed)
 
 # SNIPPET 3: load data
 dataset_url = 'https://raw.githubusercontent.com/sandramv/ML_tutorial/main/Data/ml_tutorial_data.csv'
-dataset_df = pd.read_csv(dataset_url, index_col='ID')
+
+# the data is downloaded only the first time the tutorial runs, after that it
+# is read from a local copy. The copy is named after a hash of dataset_url, so
+# changing the URL downloads a new copy. To download the data again (e.g. after
+# it was updated on GitHub), delete the ~/.cache/ml_tutorial folder.
+url_hash = hashlib.sha256(dataset_url.encode()).hexdigest()[:16]
+dataset_path = pathlib.Path('~/.cache/ml_tutorial').expanduser() / ('ml_tutorial_data_%s.csv' % url_hash)
+if not dataset_path.exists():
+    dataset_path.parent.mkdir(parents=True, exist_ok=True)
+    # download to a temporary file first so that an interrupted download is not
+    # mistaken for the data the next time the tutorial runs
+    download_path = dataset_path.with_suffix('.part')
+    urllib.request.urlretrieve(dataset_url, download_path)
+    download_path.replace(dataset_path)
+
+# the brain measures are read directly as float32, the data type they are
+# kept in (snippet 10), while the ID, diagnosis and sex columns keep their own
+# data types.
+# The default parser is used on purpose: engine='pyarrow' only applies the
+# explicitly named types and would read the brain measures as float64.
+column_dtypes = defaultdict(lambda: np.float32, ID=str, Diagnosis=np.int8, Sex=int)
+dataset_df = pd.read_csv(dataset_path, index_col='ID', dtype=column_dtypes)
 
 
 # In[ ]:
@@ -154,7 +181,7 @@ features_df
 # * Setup de CV scheme 
 # * Change data type of features and target variables   
 # * Create structure to hold the results from each CV fold  
-# * Iterate over each cv fold (snippet 22) and: 
+# * Iterate over each cv fold (snippet 12), running the folds in parallel, and: 
 #   * Split all data into train and test sets  
 #   * Normalize data
 #   * Define machine learning algorithm
@@ -170,6 +197,12 @@ features_df
 n_folds = 10
 skf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_seed)
 
+# the train and test indices of each fold are computed once and can be reused
+# to train and compare different models on exactly the same folds. They are
+# stored as int32, half the size of the int64 indices returned by skf.split.
+cv_splits = [(train_idx.astype(np.int32), test_idx.astype(np.int32))
+             for train_idx, test_idx in skf.split(features_df, targets_df)]
+
 
 # ![alt text](https://raw.githubusercontent.com/sandramv/MRInference_ML_Tutorial/master/Figures/crossvalidation.png)
 
@@ -177,75 +210,103 @@ skf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_seed)
 
 
 # SNIPPET 10: change data type 
-targets = targets_df.values.astype('int')
-features = features_df.values.astype('float32')
+targets = targets_df.to_numpy(dtype=np.int8, copy=False)
+features = features_df.to_numpy(dtype=np.float32, copy=False)
 
 
 # In[ ]:
 
 
 # SNIPPET 11: create structure to hold the results from each cross-validaiton fold
-acc_cv = np.zeros((n_folds, 1))
-bac_cv = np.zeros((n_folds, 1))
-sens_cv = np.zeros((n_folds, 1))
-spec_cv = np.zeros((n_folds, 1))
+# one row per fold, one column per metric: accuracy, balanced accuracy, sensitivity and specificity
+metrics_cv = np.zeros((n_folds, 4), dtype=np.float32)
 
 
 # In[ ]:
 
 
 # SNIPPET 12: iterate over each cv fold
-for i_fold, (train_idx, test_idx) in enumerate(skf.split(features, targets)):
+# The folds are independent of each other, so each one is trained by run_fold
+# in a separate process and the results are printed once all folds are done.
+
+# The scaler and the classifier are chained in a pipeline, which fits the
+# scaler on the train set only and uses it to normalize the train and test sets.
+# fit() always retrains from scratch. The folds are deliberately not
+# warm-started from the previous fold's coefficients, because that model was
+# trained on most of the current test fold.
+model = Pipeline([
+    ('scaler', StandardScaler()),
+    # the squared hinge loss lets the SVM be solved in its primal form
+    # (dual=False), which is much faster when there are more features than
+    # participants; the standard hinge loss is only available with dual=True.
+    # The report below flags any fold that reaches max_iter: if that happens,
+    # increase max_iter.
+    ('svm', LinearSVC(loss='squared_hinge', dual=False, C=1.0, tol=1e-3, max_iter=500)),
+])
+
+
+def run_fold(model, features, targets, train_idx, test_idx):
 
     # SNIPPET 13: split data into train and test sets
     features_train, features_test = features[train_idx], features[test_idx]
     targets_train, targets_test = targets[train_idx], targets[test_idx]
 
-    print('CV iteration: %d' % (i_fold + 1))
-    print('Training set size: %d' % len(targets_train))
-    print('Test set size: %d' % len(targets_test))
-
-    # --------------------------------------------------------------------------
-    # SNIPPET 14: normalize data
-    scaler = StandardScaler()
-
-    scaler.fit(features_train)
-
-    features_train_norm = scaler.transform(features_train)
-    features_test_norm = scaler.transform(features_test)
-
     # --------------------------------------------------------------------------
-    # SNIPPET 15: define and train the classifier (SVM)
-    clf = LinearSVC(loss='hinge')
-    clf.fit(features_train_norm, targets_train)
+    # SNIPPET 14 and 15: normalize the data and train the classifier (SVM)
+    # The solver's convergence warning is silenced here only; the number of
+    # iterations is printed for each fold.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+        model.fit(features_train, targets_train)
 
     # --------------------------------------------------------------------------
-    # SNIPPET 16: make predictions in the test set
-    target_test_predicted = clf.predict(features_test_norm)
+    # SNIPPET 16: normalize the test set and make predictions
+    target_test_predicted = model.predict(features_test)
 
     # --------------------------------------------------------------------------
     # SNIPPET 17: compute performance metrics in the test set
-    print('Confusion matrix')
     cm = confusion_matrix(targets_test, target_test_predicted)
-    print(cm)
 
+    # all metrics can be computed from the four counts in the confusion matrix
     tn, fp, fn, tp = cm.ravel()
 
-    acc_test = accuracy_score(targets_test, target_test_predicted)
-    bac_test = balanced_accuracy_score(targets_test, target_test_predicted)
     sens_test = tp / (tp + fn)
     spec_test = tn / (tn + fp)
+    acc_test = (tp + tn) / (tn + fp + fn + tp)
+    bac_test = (sens_test + spec_test) / 2
 
-    print('Accuracy: %.3f ' % acc_test)
-    print('Balanced accuracy: %.3f ' % bac_test)
-    print('Sensitivity: %.3f ' % sens_test)
-    print('Specificity: %.3f ' % spec_test)
+    n_iter = model.named_steps['svm'].n_iter_
 
-    acc_cv[i_fold, :] = acc_test
-    bac_cv[i_fold, :] = bac_test
-    sens_cv[i_fold, :] = sens_test
-    spec_cv[i_fold, :] = spec_test
-    print('--------------------------------------------------------------------------')
+    return len(targets_train), len(targets_test), n_iter, cm, acc_test, bac_test, sens_test, spec_test
+
+
+fold_results = Parallel(n_jobs=-1, backend='loky')(
+    delayed(run_fold)(model, features, targets, train_idx, test_idx)
+    for train_idx, test_idx in cv_splits)
+
+# the report of every fold is collected in fold_log and printed all at once
+max_iter = model.named_steps['svm'].max_iter
+fold_log = []
+for i_fold, (n_train, n_test, n_iter, cm, acc_test, bac_test, sens_test, spec_test) in enumerate(fold_results):
+    fold_log.append('CV iteration: %d' % (i_fold + 1))
+    fold_log.append('Training set size: %d' % n_train)
+    fold_log.append('Test set size: %d' % n_test)
+    fold_log.append('SVM solver iterations: %d of max %d' % (n_iter, max_iter))
+    if n_iter >= max_iter:
+        fold_log.append('WARNING: the SVM solver reached max_iter before converging')
+
+    fold_log.append('Confusion matrix')
+    fold_log.append(str(cm))
+
+    fold_log.append('Accuracy: %.3f ' % acc_test)
+    fold_log.append('Balanced accuracy: %.3f ' % bac_test)
+    fold_log.append('Sensitivity: %.3f ' % sens_test)
+    fold_log.append('Specificity: %.3f ' % spec_test)
+
+    metrics_cv[i_fold] = acc_test, bac_test, sens_test, spec_test
+    fold_log.append('--------------------------------------------------------------------------')
+
+print('\n'.join(fold_log))
 
 
 # ## 5. Model evaluation  
@@ -255,11 +316,12 @@ for i_fold, (train_idx, test_idx) in enumerate(skf.split(features, targets)):
 
 
 # SNIPPET 18
+metrics_mean = metrics_cv.mean(axis=0)
+metrics_std = metrics_cv.std(axis=0)
+
 print('CV results')
-print('Acc: Mean(SD) = %.3f(%.3f)' % (acc_cv.mean(), acc_cv.std()))
-print('Bac: Mean(SD) = %.3f(%.3f)' % (bac_cv.mean(), bac_cv.std()))
-print('Sens: Mean(SD) = %.3f(%.3f)' % (sens_cv.mean(), sens_cv.std()))
-print('Spec: Mean(SD) = %.3f(%.3f)' % (spec_cv.mean(), spec_cv.std()))
+for i_metric, metric_name in enumerate(['Acc', 'Bac', 'Sens', 'Spec']):
+    print('%s: Mean(SD) = %.3f(%.3f)' % (metric_name, metrics_mean[i_metric], metrics_std[i_metric]))
 
 
 # ## 6. Post-hoc analysis
@@ -293,7 +355,9 @@ print('Spec: Mean(SD) = %.3f(%.3f)' % (spec_cv.mean(), spec_cv.std()))
 
 
 # SNIPPET 19
-sns.countplot(x='Diagnosis', hue='Sex', data=dataset_df, palette=['#839098', '#f7d842'])
+sex_counts_df = pd.crosstab(dataset_df['Diagnosis'], dataset_df['Sex'])
+sex_counts_df.plot.bar(color=['#839098', '#f7d842'], rot=0)
+plt.ylabel('count')
 plt.legend(['Male', 'Female'])
 plt.show()
 